@@ -23,10 +23,24 @@ E.g.::
     state = step.ZeroState(
         step.theta, prepared_inputs, batch_size)
     for t in range(T):
-      step_inputs = input_batch.Transform(lambda x: x[:, i, ...])
+      step_inputs = step.SliceInputsForStep(input_batch, t)
       step_outputs, state = step.FProp(
           step.theta, prepared_inputs, step_inputs, state)
       (processing step_outputs...)
+
+The Python loop above builds a new copy of the step graph for every time step.
+StackStep.FPropSequence runs the same computation inside a single
+tf.while_loop, so the graph for one step is built only once::
+
+  prepared_inputs = stack.PrepareExternalInputs(stack.theta, external_inputs)
+  outputs, final_state = stack.FPropSequence(
+      stack.theta, prepared_inputs,
+      py_utils.NestedMap(inputs=[inputs], paddings=paddings))
+
+Sequences are preferably laid out time-major, i.e. [time, batch_size, ...]:
+each time step is then a contiguous slice, which the sequence drivers read from
+a TensorArray without any per-step slicing ops. FPropSequence transposes
+batch-major inputs once, before its loop, when called with time_major=False.
 """
 
 from __future__ import absolute_import
@@ -34,6 +48,7 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import contextlib
 
 from lingvo import compat as tf
 from lingvo.core import base_layer
@@ -41,6 +56,7 @@ from lingvo.core import builder_layers
 from lingvo.core import py_utils
 from lingvo.core import recurrent
 import six
+from six.moves import intern
 from six.moves import range
 
 
@@ -104,6 +120,20 @@ class Step(base_layer.BaseLayer):
                                        batch_size)
     return state0
 
+  def SliceInputsForStep(self, input_batch, t, time_axis=1):
+    """Returns the inputs of time step t.
+
+    Args:
+      input_batch: A `.NestedMap` of tensors with a time dimension.
+      t: An int or int32 scalar tensor, the time step.
+      time_axis: The time dimension of the tensors in input_batch.
+
+    Returns:
+      A `.NestedMap` with the same structure as input_batch, containing the
+      slices of its tensors at time t, without the time dimension.
+    """
+    return input_batch.Transform(lambda x: tf.gather(x, t, axis=time_axis))
+
   def FProp(self, theta, prepared_inputs, step_inputs, padding, state0):
     """Forward function.
 
@@ -176,7 +206,116 @@ class StatelessLayerStep(Step):
     return output, py_utils.NestedMap()
 
 
-class StackStep(Step):
+class SoAStateAdapter(object):
+  """Mixin translating between per-sub-step and stacked recurrent states.
+
+  A step made of N sub-steps normally keeps its state as a list called 'sub'
+  holding one `.NestedMap` per sub-step. When all the sub-step states have the
+  same structure, shapes and dtypes, the state can instead be a `.NestedMap`
+  called 'stacked' with the same structure as a single sub-step state, whose
+  leaves are [N, ...] tensors. Each state field is then a single tensor,
+  instead of N small ones.
+
+  Converting between the two layouts costs one unstack and one stack per
+  state field, so steps should convert once per sequence rather than once per
+  time step.
+  """
+
+  def StackSubStates(self, sub_states):
+    """Stacks a list of sub-step states.
+
+    Args:
+      sub_states: A list of sub-step states.
+
+    Returns:
+      A `.NestedMap` containing the stacked states called 'stacked', or None if
+      the sub-step states can not be stacked.
+    """
+    if not sub_states:
+      return None
+    first = sub_states[0]
+    if not isinstance(first, py_utils.NestedMap):
+      return None
+    first_leaves = first.Flatten()
+    for sub_state in sub_states:
+      if (not isinstance(sub_state, py_utils.NestedMap) or
+          not first.IsCompatible(sub_state)):
+        return None
+      for x, y in zip(first_leaves, sub_state.Flatten()):
+        if not isinstance(y, tf.Tensor) or x.dtype != y.dtype:
+          return None
+        if not x.shape.is_compatible_with(y.shape):
+          return None
+    return py_utils.NestedMap(
+        stacked=first.Pack(
+            [tf.stack(xs) for xs in zip(*[s.Flatten() for s in sub_states])]))
+
+  def SubStates(self, state, num_sub):
+    """Returns the list of the num_sub sub-step states of state."""
+    if 'stacked' in state:
+      leaves = [tf.unstack(x, num=num_sub) for x in state.stacked.Flatten()]
+      return [state.stacked.Pack(list(xs)) for xs in zip(*leaves)]
+    return list(state.sub)
+
+  def PackSubStates(self, like, sub_states):
+    """Returns sub_states packed in the same layout as the state like."""
+    if 'stacked' in like:
+      return py_utils.NestedMap(
+          stacked=like.stacked.Pack([
+              tf.stack(xs) for xs in zip(*[s.Flatten() for s in sub_states])
+          ]))
+    return py_utils.NestedMap(sub=list(sub_states))
+
+
+class ZeroStateCache(object):
+  """Mixin caching the initial states of a step for static batch sizes.
+
+  The class must implement _ZeroState(theta, prepared_inputs, batch_size),
+  and call _CachedZeroState from ZeroState. The cache only holds the states
+  built in the current default graph: it is cleared when ZeroState is called
+  in another graph, so that it does not keep old graphs alive.
+  """
+
+  # The graph of the cached states, and a dict mapping static batch sizes to
+  # the cached (dependencies, zero state). Both are set on first use.
+  _zero_state_graph = None
+  _zero_state_cache = None
+
+  def _CachedZeroState(self, theta, prepared_inputs, batch_size):
+    """Returns self._ZeroState(...), cached for static batch sizes.
+
+    An entry is reused for the same batch size in the same graph if the leaves
+    of theta and prepared_inputs are the same objects.
+
+    Args:
+      theta: See ZeroState.
+      prepared_inputs: See ZeroState.
+      batch_size: See ZeroState.
+
+    Returns:
+      The initial state.
+    """
+    static_batch_size = batch_size
+    if isinstance(batch_size, tf.Tensor):
+      static_batch_size = tf.get_static_value(batch_size)
+    if static_batch_size is None:
+      return self._ZeroState(theta, prepared_inputs, batch_size)
+    graph = tf.get_default_graph()
+    if self._zero_state_graph is not graph:
+      self._zero_state_graph = graph
+      self._zero_state_cache = {}
+    key = int(static_batch_size)
+    deps = py_utils.Flatten([theta, prepared_inputs])
+    cached = self._zero_state_cache.get(key)
+    if cached is not None and len(cached[0]) == len(deps) and all(
+        x is y for x, y in zip(cached[0], deps)):
+      return cached[1]
+    state0 = self._ZeroState(theta, prepared_inputs, batch_size)
+    self._zero_state_cache[key] = (deps, state0)
+    return state0
+
+
+class StackStep(SoAStateAdapter, ZeroStateCache, Step):
   """A stack of steps.
 
   Each sub-step is assumed to accept step_inputs of type NestedMap(inputs=[])
@@ -203,12 +342,69 @@ class StackStep(Step):
         'More precisely, when i >= residual_start, the output of each step '
         'is defined as: '
         'output[i] = output[i - residual_stride] + sub[i](output[i - 1]) '
-        'where output[-1] is the step input.')
+        'where output[-1] is the step input. '
+        'It must satisfy residual_start + 1 >= residual_stride, so that '
+        'output[i - residual_stride] exists for every residual layer.')
     p.Define(
         'residual_stride', 1, 'If residual connections are active, this '
         'is the number of layers that each connection skips. For '
         'instance, setting residual_stride = 2 means the output of layer '
-        'n is added to layer n + 2')
+        'n is added to layer n + 2. Must be at least 1.')
+    p.Define(
+        'fuse_homogeneous', False, 'If True, FPropPipelined computes the '
+        'input mixing matmuls of the sub-steps whose mixing weights have the '
+        'same shape with a single batched matmul. All sub-steps must support '
+        'FusableMixShape, MixWeights, MixInputs and FPropFromMix, like '
+        'RnnStep with an LSTMCellSimple cell.')
+    p.Define(
+        'use_cudnn', False, 'If True and all the sub-steps compute plain '
+        'LSTMs of the same size (see RnnStep.CudnnLSTMShape), FPropSequence '
+        'runs the whole stack with a single cuDNN kernel. Only supported on '
+        'GPU. Outputs at padded time steps are zeros in this case. The '
+        'paddings must be trailing: cuDNN only takes the length of each '
+        'sequence, so leading padding is processed as regular input.')
+    p.Define(
+        'skip_padded_steps', False, 'If True, FProp does not run the '
+        'sub-steps on time steps where the whole batch is padded; it returns '
+        'state0 and the output of the top-most sub-step for its state0 '
+        'instead, without residual connections. All the sub-steps must keep '
+        'their state on padded time steps, see RnnStep.KeepsStateOnPadding, '
+        'and the top-most one must implement PassThroughOutput. '
+        'FPropSequence also stops after the last time step which is not '
+        'fully padded, and outputs zeros after it, where calling FProp step '
+        'by step would output the passed through output.')
+    p.Define(
+        'use_xla_jit', False, 'If True, the ops of FProp and of each tick of '
+        'FPropPipelined are compiled with XLA, which fuses the small '
+        'per-step ops into fewer kernels. FPropSequence and FPropPipelined '
+        'keep their loop over time outside of the compiled ops, so the '
+        'sequence length may be dynamic.')
+    p.Define(
+        'compute_dtype', None, 'If set, e.g. to tf.bfloat16 or tf.float16, '
+        'the floating point inputs, weights, external inputs and states of '
+        'each sub-step are cast to this dtype before its FProp, and its '
+        'outputs and states are cast back to the fprop dtype. The residual '
+        'connections are thus added in the fprop dtype and the state is kept '
+        'in it between steps, but it is rounded to compute_dtype on every '
+        'step. All the sub-steps must support it, see '
+        'RnnStep.SupportsReducedPrecision. It can not be combined with '
+        'use_cudnn or fuse_homogeneous.')
+    p.Define(
+        'stacked_state', False, 'If True and the states of all the sub-steps '
+        'have the same structure, shapes and dtypes, ZeroState returns a '
+        'NestedMap(stacked=...) whose leaves are the [num_sub, ...] stacks '
+        'of the sub-step states, instead of NestedMap(sub=[...]). FProp '
+        'preserves the layout of state0, at the cost of one unstack and one '
+        'stack per state field and call. FPropSequence and FPropPipelined '
+        'only convert the layout once per sequence, and the cuDNN path '
+        'consumes it directly, so the stacked layout pays off with them '
+        'rather than when FProp is called step by step.')
+    p.Define(
+        'cache_zero_state', False, 'If True, ZeroState caches its result for '
+        'static batch sizes, and returns it again for the same batch size, '
+        'graph, weights and prepared inputs. The cached state must only be '
+        'used where the first one could be used, e.g. not across '
+        'control flow contexts.')
     return p
 
   @base_layer.initializer
@@ -218,6 +414,119 @@ class StackStep(Step):
     with tf.variable_scope(p.name):
       self.sub_steps = []
       self.CreateChildren('sub', p.sub)
+    if p.skip_padded_steps and p.sub:
+      # Skipping a padded time step must not change the results.
+      for sub in self.sub:
+        if not (hasattr(sub, 'KeepsStateOnPadding') and
+                sub.KeepsStateOnPadding()):
+          raise ValueError(
+              '%s: skip_padded_steps requires sub-step %s to keep its state '
+              'on padded time steps.' % (p.name, sub.params.name))
+      if not hasattr(self.sub[-1], 'PassThroughOutput'):
+        raise ValueError(
+            'skip_padded_steps requires the top-most sub-step to implement '
+            'PassThroughOutput.')
+    if p.residual_start >= 0:
+      # Validated once here, so that the residual connections of FProp and
+      # FPropPipelined need no checks.
+      if p.residual_stride < 1:
+        raise ValueError(
+            'residual_stride must be at least 1: %d' % p.residual_stride)
+      if p.residual_start + 1 < p.residual_stride:
+        raise ValueError(
+            'residual_start + 1 must be at least residual_stride: %d vs %d' %
+            (p.residual_start + 1, p.residual_stride))
+    # Groups of indices of sub-steps whose input mixing is fused.
+    self._fused_groups = []
+    if p.fuse_homogeneous:
+      shapes = [
+          sub.FusableMixShape() if hasattr(sub, 'FusableMixShape') else None
+          for sub in self.sub
+      ]
+      if None in shapes:
+        tf.logging.warning(
+            '%s: Not fusing sub-steps since some of them do not support it.',
+            p.name)
+      else:
+        groups = collections.OrderedDict()
+        for i, shape in enumerate(shapes):
+          groups.setdefault(shape, []).append(i)
+        self._fused_groups = [g for g in groups.values() if len(g) > 1]
+    self._cudnn = None
+    if p.use_cudnn and p.sub:
+      self._cudnn = self._TryBuildCudnnRNN(self.sub)
+    if p.compute_dtype is not None:
+      self._CheckComputeDtype()
+
+  def _CheckComputeDtype(self):
+    """Validates params.compute_dtype against the sub-steps.
+
+    Raises:
+      ValueError: if a sub-step or another param does not support it.
+    """
+    p = self.params
+    if p.use_cudnn or p.fuse_homogeneous:
+      raise ValueError(
+          'compute_dtype can not be combined with use_cudnn or '
+          'fuse_homogeneous.')
+    for sub in self.sub:
+      if not (hasattr(sub, 'SupportsReducedPrecision') and
+              sub.SupportsReducedPrecision()):
+        raise ValueError('%s: Sub-step %s does not support compute_dtype.' %
+                         (p.name, sub.params.name))
+    multiple = 16 if p.compute_dtype == tf.bfloat16 else 8
+    for sub in self.sub:
+      cell = getattr(sub.params, 'cell', None)
+      if cell is None:
+        continue
+      for key in ('num_input_nodes', 'num_output_nodes', 'num_hidden_nodes'):
+        size = getattr(cell, key, 0)
+        if size and size % multiple:
+          tf.logging.warning(
+              '%s: %s.%s = %d is not a multiple of %d, which prevents the use '
+              'of Tensor Cores in %s.', p.name, sub.params.name, key, size,
+              multiple, p.compute_dtype.name)
+
+  def _TryBuildCudnnRNN(self, subs, num_dirs=1):
+    """Returns the configuration of a stack of sub-steps as a cuDNN LSTM.
+
+    Args:
+      subs: The list of the sub-steps of each direction, one direction after
+        the other.
+      num_dirs: The number of directions, 1 or 2.
+
+    Returns:
+      A `.NestedMap` containing num_layers, num_units and input_size, or None
+      if the stack can not be run as a cuDNN LSTM.
+    """
+    p = self.params
+
+    def _Unsupported(reason):
+      tf.logging.warning('%s: Not using cuDNN since %s.', p.name, reason)
+      return None
+
+    if p.residual_start >= 0:
+      return _Unsupported('residual connections are enabled')
+    shapes = [
+        sub.CudnnLSTMShape() if hasattr(sub, 'CudnnLSTMShape') else None
+        for sub in subs
+    ]
+    if not shapes or None in shapes:
+      return _Unsupported('some sub-steps are not plain LSTMs')
+    num_layers = len(shapes) // num_dirs
+    input_size, num_units = shapes[0]
+    for i, (layer_input_size, units) in enumerate(shapes):
+      # Layers above the first one read the outputs of all the directions.
+      expected_input_size = (
+          input_size if i % num_layers == 0 else num_dirs * num_units)
+      if units != num_units or layer_input_size != expected_input_size:
+        return _Unsupported('the LSTM sizes are not uniform')
+    if num_units % 8:
+      tf.logging.warning(
+          '%s: cuDNN LSTM size %d is not a multiple of 8, which prevents the '
+          'use of Tensor Cores.', p.name, num_units)
+    return py_utils.NestedMap(
+        num_layers=num_layers, num_units=num_units, input_size=input_size)
 
   def PrepareExternalInputs(self, theta, external_inputs):
     """Delegates external inputs preparation to sub-layers.
@@ -232,11 +541,10 @@ class StackStep(Step):
       A `.NestedMap` containing a pre-processed version of the external_inputs,
       one per sub-step.
     """
-    packed = py_utils.NestedMap(sub=[])
-    for i in range(len(self.sub)):
-      packed.sub.append(self.sub[i].PrepareExternalInputs(
-          theta.sub[i], external_inputs))
-    return packed
+    return py_utils.NestedMap(sub=[
+        self.sub[i].PrepareExternalInputs(theta.sub[i], external_inputs)
+        for i in range(len(self.sub))
+    ])
 
   def ZeroState(self, theta, prepared_inputs, batch_size):
     """Computes a zero state for each sub-step.
@@ -248,12 +556,27 @@ class StackStep(Step):
       batch_size: The number of items in the batch that FProp will process.
 
     Returns:
-      A `.NestedMap` containing a state0 object for each sub-step.
+      A `.NestedMap` containing a state0 object for each sub-step, either as a
+      list called 'sub', or stacked in 'stacked' if params.stacked_state is
+      set (see SoAStateAdapter).
     """
-    state = py_utils.NestedMap(sub=[])
-    for i in range(len(self.sub)):
-      state.sub.append(self.sub[i].ZeroState(theta.sub[i], prepared_inputs,
-                                             batch_size))
+    if self.params.cache_zero_state:
+      return self._CachedZeroState(theta, prepared_inputs, batch_size)
+    return self._ZeroState(theta, prepared_inputs, batch_size)
+
+  def _ZeroState(self, theta, prepared_inputs, batch_size):
+    """Implementation of ZeroState, see ZeroState for the arguments."""
+    state = py_utils.NestedMap(sub=[
+        self.sub[i].ZeroState(theta.sub[i], prepared_inputs, batch_size)
+        for i in range(len(self.sub))
+    ])
+    if self.params.stacked_state:
+      stacked = self.StackSubStates(state.sub)
+      if stacked is not None:
+        return stacked
+      tf.logging.warning(
+          '%s: Not stacking the states since the sub-step states differ.',
+          self.params.name)
     return state
 
   def FProp(self, theta, prepared_inputs, step_inputs, padding, state0):
@@ -271,7 +594,8 @@ class StackStep(Step):
         its children layers.
       prepared_inputs: An output from PrepareExternalInputs.
       step_inputs: A `.NestedMap` containing a list called 'inputs', an
-        optionally a tensor called 'context'.
+        optionally a tensor called 'context'. It may also contain the
+        'concat_inputs' computed by PreprocessInputs.
       padding: A 0/1 float tensor of shape [batch_size]; 1.0 means that this
         batch element is empty in this step.
       state0: The previous recurrent state.
@@ -282,29 +606,753 @@ class StackStep(Step):
       - output: A `.NestedMap` containing the output of the top-most step.
       - state1: The recurrent state to feed to next invocation of this graph.
     """
-    state1 = py_utils.NestedMap(sub=[])
+    p = self.params
+    with _MaybeXlaJitScope(p.use_xla_jit):
+      if not p.skip_padded_steps:
+        return self._FPropSubSteps(theta, prepared_inputs, step_inputs,
+                                   padding, state0)
+      return self._FPropSkippingPadding(theta, prepared_inputs, step_inputs,
+                                        padding, state0)
+
+  def _FPropSkippingPadding(self, theta, prepared_inputs, step_inputs, padding,
+                            state0):
+    """Runs the sub-steps unless the whole batch is padded."""
+
+    def _Run():
+      return self._FPropSubSteps(theta, prepared_inputs, step_inputs, padding,
+                                 state0)
+
+    def _Skip():
+      top = len(self.sub) - 1
+      output = self.sub[top].PassThroughOutput(
+          theta.sub[top], prepared_inputs.sub[top],
+          self.SubStates(state0, len(self.sub))[top])
+      return py_utils.NestedMap(output=output), state0
+
+    return tf.cond(tf.reduce_any(padding < 1.0), _Run, _Skip)
+
+  def _FPropSubSteps(self, theta, prepared_inputs, step_inputs, padding,
+                     state0):
+    """Runs the sub-steps on one time step. See FProp for the arguments."""
+    sub_states0 = self.SubStates(state0, len(self.sub))
+    sub_states1 = []
     inputs = list(step_inputs.inputs)
     # We pretend that the input is the output of layer -1 for the purposes
-    # of residual connections.
-    residual_inputs = [tf.concat(inputs, axis=1)]
+    # of residual connections. Only the last residual_stride outputs are kept:
+    # ring[0] is the output of layer i - residual_stride.
+    ring = collections.deque(maxlen=max(1, self.params.residual_stride))
+    if 'concat_inputs' in step_inputs:
+      ring.append(step_inputs.concat_inputs)
+    elif self.params.residual_start >= 0:
+      ring.append(tf.concat(inputs, axis=1))
     additional = []
     if 'context' in step_inputs:
       additional.append(step_inputs.context)
     for i in range(len(self.sub)):
       sub_inputs = py_utils.NestedMap(inputs=inputs + additional)
-      sub_output, state1_i = self.sub[i].FProp(theta.sub[i],
-                                               prepared_inputs.sub[i],
-                                               sub_inputs, padding,
-                                               state0.sub[i])
-      state1.sub.append(state1_i)
+      sub_output, state1_i = self._SubFProp(i, theta, prepared_inputs,
+                                            sub_inputs, padding,
+                                            sub_states0[i])
+      sub_states1.append(state1_i)
       output = sub_output.output
       if i >= self.params.residual_start >= 0:
-        # residual_inputs contains the step input at residual_inputs[0].
-        assert i + 1 - self.params.residual_stride < len(residual_inputs)
-        output += residual_inputs[i + 1 - self.params.residual_stride]
-      residual_inputs.append(output)
+        output += ring[0]
+      ring.append(output)
       inputs = [output]
-    return py_utils.NestedMap(output=output), state1
+    return py_utils.NestedMap(output=output), self.PackSubStates(
+        state0, sub_states1)
+
+  def _SubFProp(self, i, theta, prepared_inputs, sub_inputs, padding, state0):
+    """Runs FProp of sub-step i, in params.compute_dtype if set.
+
+    The casts of theta and prepared_inputs are no-ops if the caller already
+    cast them, as the sequence drivers do outside of their loops.
+    """
+    compute_dtype = self.params.compute_dtype
+    if compute_dtype is None:
+      return self.sub[i].FProp(theta.sub[i], prepared_inputs.sub[i], sub_inputs,
+                               padding, state0)
+    fprop_dtype = py_utils.FPropDtype(self.params)
+    sub_output, state1 = self.sub[i].FProp(
+        _CastFloats(theta.sub[i], compute_dtype),
+        _CastFloats(prepared_inputs.sub[i], compute_dtype),
+        _CastFloats(sub_inputs, compute_dtype),
+        _CastFloats(padding, compute_dtype),
+        _CastFloats(state0, compute_dtype))
+    return (_CastFloats(sub_output, fprop_dtype),
+            _CastFloats(state1, fprop_dtype))
+
+  def PreprocessInputs(self, input_batch):
+    """Computes the input transformations of a whole sequence at once.
+
+    This is called by the sequence drivers before their loop, so that the
+    work is not repeated on every time step.
+
+    Args:
+      input_batch: See FPropSequence.
+
+    Returns:
+      A copy of input_batch. If residual connections are enabled, it contains
+      an additional [time, batch_size, ...] tensor called 'concat_inputs': the
+      concatenation of the 'inputs' list, which FProp uses as the output of
+      layer -1.
+    """
+    input_batch = input_batch.copy()
+    if self.params.residual_start >= 0:
+      # The inputs are [time, batch_size, ...], so FProp's concatenation axis
+      # is shifted by one.
+      input_batch.concat_inputs = tf.concat(input_batch.inputs, axis=2)
+    return input_batch
+
+  def _UnstackInputBatch(self, input_batch):
+    """Unstacks the [time, ...] tensors of input_batch into TensorArrays.
+
+    Args:
+      input_batch: See FPropSequence.
+
+    Returns:
+      A tuple (inputs_ta, paddings_ta), where inputs_ta is a `.NestedMap`
+      with the same structure as the step_inputs of FProp.
+    """
+    paddings = input_batch.paddings
+    seq_len = py_utils.GetShape(paddings, 1)[0]
+    step_inputs = py_utils.NestedMap(inputs=list(input_batch.inputs))
+    if 'context' in input_batch:
+      step_inputs.context = input_batch.context
+    if 'concat_inputs' in input_batch:
+      step_inputs.concat_inputs = input_batch.concat_inputs
+    inputs_ta = step_inputs.Transform(
+        lambda x: tf.TensorArray(x.dtype, seq_len).unstack(x))
+    paddings_ta = tf.TensorArray(paddings.dtype, seq_len).unstack(paddings)
+    return inputs_ta, paddings_ta
+
+  def FPropSequence(self,
+                    theta,
+                    prepared_inputs,
+                    input_batch,
+                    state0=None,
+                    time_major=True):
+    """Runs FProp over a whole sequence inside a single tf.while_loop.
+
+    This is equivalent to calling FProp once per time step from Python, but
+    the graph of a single step is only built once, independent of the
+    sequence length.
+
+    If params.use_cudnn is set and the stack is a plain LSTM stack without
+    context or external inputs, the whole computation is a single cuDNN call.
+
+    Args:
+      theta: A `.NestedMap` object containing weights' values of this layer and
+        its children layers.
+      prepared_inputs: An output from PrepareExternalInputs.
+      input_batch: A `.NestedMap` containing a list called 'inputs' of
+        [time, batch_size, ...] tensors, optionally a [time, batch_size, ...]
+        tensor called 'context', and a 0/1 float tensor called 'paddings' of
+        shape [time, batch_size, ...]; 1.0 means that this batch element is
+        empty in this step.
+      state0: The initial recurrent state. If None, ZeroState() is used.
+      time_major: If False, the tensors of input_batch and output are
+        [batch_size, time, ...] instead. They are transposed once, outside of
+        the loop.
+
+    Returns:
+      A tuple (output, state1):
+
+      - output: A `.NestedMap` containing the [time, batch_size, ...] outputs
+        of the top-most step.
+      - state1: The recurrent state after the last time step.
+    """
+    if not time_major:
+      output, state1 = self.FPropSequence(
+          theta, prepared_inputs, input_batch.Transform(_SwapTimeAndBatch),
+          state0)
+      return output.Transform(_SwapTimeAndBatch), state1
+
+    p = self.params
+    paddings = input_batch.paddings
+    seq_len, batch_size = py_utils.GetShape(paddings, 2)
+    if state0 is None:
+      state0 = self.ZeroState(theta, prepared_inputs, batch_size)
+
+    if self._cudnn and 'context' not in input_batch and all(
+        x is None or isinstance(x, py_utils.NestedMap)
+        for x in prepared_inputs.sub):
+      return self._FPropSequenceCudnn(theta, input_batch, state0)
+
+    if p.compute_dtype is not None:
+      # Casts the weights and external inputs once, outside of the loop.
+      theta = _CastFloats(theta, p.compute_dtype)
+      prepared_inputs = _CastFloats(prepared_inputs, p.compute_dtype)
+
+    num_steps = seq_len
+    if p.skip_padded_steps:
+      # Stops after the last time step which has a non-padded element; the
+      # following steps would leave the state unchanged and output zeros.
+      active = tf.reduce_any(
+          tf.reshape(paddings, [seq_len, -1]) < 1.0, axis=1)
+      num_steps = tf.reduce_max(
+          tf.where(active, tf.range(1, seq_len + 1), tf.ones([seq_len],
+                                                             tf.int32)))
+
+    inputs_ta, paddings_ta = self._UnstackInputBatch(
+        self.PreprocessInputs(input_batch))
+    # The loop carries the sub-step states separately, so that a stacked state0
+    # is only converted once, outside of the loop.
+    outputs, state1 = self._FPropLoop(
+        lambda *args: self.FProp(theta, prepared_inputs, *args), inputs_ta,
+        paddings_ta,
+        py_utils.NestedMap(sub=self.SubStates(state0, len(self.sub))),
+        num_steps)
+    state1 = self.PackSubStates(state0, state1.sub)
+    if p.skip_padded_steps:
+      outputs = py_utils.PadOrTrimTo(outputs,
+                                     [seq_len] + py_utils.GetShape(outputs)[1:])
+    return py_utils.NestedMap(output=outputs), state1
+
+  def _FPropLoop(self, fprop, inputs_ta, paddings_ta, state0, num_steps):
+    """Runs fprop on the first num_steps time steps in a tf.while_loop.
+
+    Args:
+      fprop: A function (step_inputs, padding, state0) -> (output, state1),
+        like FProp without its theta and prepared_inputs arguments.
+      inputs_ta: A `.NestedMap` of TensorArrays, read at each time step to
+        produce step_inputs.
+      paddings_ta: A TensorArray of the paddings of each time step.
+      state0: The initial recurrent state.
+      num_steps: The number of time steps to run.
+
+    Returns:
+      A tuple (outputs, state1), where outputs stacks the 'output' of the time
+      steps, and state1 is the state after the last one.
+    """
+    output_ta = tf.TensorArray(py_utils.FPropDtype(self.params), num_steps)
+
+    def _Step(t, output_ta, flat_state0):
+      """Runs fprop on time step t."""
+      output, state1 = fprop(
+          inputs_ta.Transform(lambda ta: ta.read(t)), paddings_ta.read(t),
+          py_utils.Pack(state0, flat_state0))
+      output_ta = output_ta.write(t, output.output)
+      return t + 1, output_ta, py_utils.Flatten(state1)
+
+    _, output_ta, flat_state1 = tf.while_loop(
+        lambda t, *_: t < num_steps,
+        _Step,
+        loop_vars=(tf.constant(0, tf.int32), output_ta,
+                   py_utils.Flatten(state0)),
+        parallel_iterations=1,
+        swap_memory=True)
+    return output_ta.stack(), py_utils.Pack(state0, flat_state1)
+
+  def _FPropSequenceCudnn(self, theta, input_batch, state0):
+    """FPropSequence implementation running the stack as one cuDNN LSTM."""
+    paddings = input_batch.paddings
+    seq_len, batch_size = py_utils.GetShape(paddings, 2)
+    seq_lengths = py_utils.LengthsFromPaddings(
+        tf.transpose(tf.reshape(paddings, [seq_len, batch_size])))
+    if 'stacked' in state0:
+      input_h, input_c = state0.stacked.m, state0.stacked.c
+    else:
+      input_h = tf.stack([s.m for s in state0.sub])
+      input_c = tf.stack([s.c for s in state0.sub])
+    result = tf.raw_ops.CudnnRNNV3(
+        input=tf.concat(input_batch.inputs, axis=2),
+        input_h=input_h,
+        input_c=input_c,
+        params=_CudnnOpaqueParams(self._cudnn, [
+            self.sub[i].CudnnLSTMWeights(theta.sub[i])
+            for i in range(len(self.sub))
+        ]),
+        sequence_lengths=seq_lengths,
+        rnn_mode='lstm',
+        input_mode='linear_input',
+        direction='unidirectional',
+        is_training=not self.do_eval,
+        time_major=True)
+    if 'stacked' in state0:
+      state1 = py_utils.NestedMap(
+          stacked=py_utils.NestedMap(m=result.output_h, c=result.output_c))
+      return py_utils.NestedMap(output=result.output), state1
+    num_layers = self._cudnn.num_layers
+    state1 = py_utils.NestedMap(sub=[
+        py_utils.NestedMap(m=m, c=c)
+        for m, c in zip(
+            tf.unstack(result.output_h, num=num_layers),
+            tf.unstack(result.output_c, num=num_layers))
+    ])
+    return py_utils.NestedMap(output=result.output), state1
+
+  def FPropPipelined(self, theta, prepared_inputs, input_batch, state0=None):
+    """Runs the stack over a whole sequence with a wavefront schedule.
+
+    At tick k, sub-step i processes time step k - i. Within a tick, the
+    sub-steps do not depend on each other, so they can execute in parallel,
+    and the sequence takes len(sub) + time - 1 ticks instead of
+    len(sub) * time sequential sub-step calls.
+
+    The input of each sub-step is carried from one tick to the next together
+    with the outputs of the previous residual_stride - 1 layers, which are
+    needed for the residual connections.
+
+    The results are the same as the ones of FPropSequence, except at the time
+    steps where the whole batch is padded if params.skip_padded_steps is set:
+    FPropSequence skips them, while FPropPipelined runs all the time steps.
+
+    If params.fuse_homogeneous is set, the input mixing matmuls of the
+    sub-steps of a tick are computed with one batched matmul per group of
+    sub-steps with same-shaped weights.
+
+    Args:
+      theta: A `.NestedMap` object containing weights' values of this layer and
+        its children layers.
+      prepared_inputs: An output from PrepareExternalInputs.
+      input_batch: A `.NestedMap` containing a list called 'inputs' of
+        [time, batch_size, ...] tensors, optionally a [time, batch_size, ...]
+        tensor called 'context', and a 0/1 float tensor called 'paddings' of
+        shape [time, batch_size, ...]; 1.0 means that this batch element is
+        empty in this step.
+      state0: The initial recurrent state. If None, ZeroState() is used.
+
+    Returns:
+      A tuple (output, state1):
+
+      - output: A `.NestedMap` containing the [time, batch_size, ...] outputs
+        of the top-most step.
+      - state1: The recurrent state after the last time step.
+    """
+    p = self.params
+    num_sub = len(self.sub)
+    paddings = input_batch.paddings
+    seq_len, batch_size = py_utils.GetShape(paddings, 2)
+    if state0 is None:
+      state0 = self.ZeroState(theta, prepared_inputs, batch_size)
+
+    if p.compute_dtype is not None:
+      # Casts the weights and external inputs once, outside of the loop.
+      theta = _CastFloats(theta, p.compute_dtype)
+      prepared_inputs = _CastFloats(prepared_inputs, p.compute_dtype)
+
+    inputs_ta, paddings_ta = self._UnstackInputBatch(
+        self.PreprocessInputs(input_batch))
+    output_ta = tf.TensorArray(py_utils.FPropDtype(p), seq_len)
+
+    # The number of previous layer outputs carried along with the input of
+    # each sub-step, i.e. output[i - 1] ... output[i - window].
+    window = 1
+    if p.residual_start >= 0:
+      window = max(window, p.residual_stride)
+
+    # The mixing weights are loop invariants, so they are stacked only once.
+    fused_weights = [
+        tf.stack([self.sub[i].MixWeights(theta.sub[i]) for i in group])
+        for group in self._fused_groups
+    ]
+
+    def _Tick(k, stages, pipes, states):
+      """Runs the sub-steps in stages on tick k.
+
+      Args:
+        k: The tick index.
+        stages: The indices of the sub-steps to run.
+        pipes: A list containing for each sub-step i the tuple
+          (output[i - 1], ..., output[i - window]) for time step k - i, i.e.
+          its input followed by the outputs of the previous layers. pipes[0]
+          is unused since the first sub-step reads its input from
+          input_batch.
+        states: The list of recurrent states of the sub-steps.
+
+      Returns:
+        A tuple (output, pipes, states), where output is the output of the
+        top-most sub-step for time step k - len(sub) + 1 (or None if it did
+        not run), and pipes and states are the values for the next tick.
+      """
+      states = list(states)
+      new_pipes = list(pipes)
+      top_output = None
+      sub_args = {}
+      for i in stages:
+        t_read = tf.minimum(k - i, seq_len - 1)
+        additional = []
+        if 'context' in inputs_ta:
+          additional.append(inputs_ta.context.read(t_read))
+        if i == 0:
+          inputs = [ta.read(t_read) for ta in inputs_ta.inputs]
+          prev_outputs = ()
+          if 'concat_inputs' in inputs_ta:
+            prev_outputs = (inputs_ta.concat_inputs.read(t_read),)
+        else:
+          prev_outputs = pipes[i]
+          inputs = [prev_outputs[0]]
+        sub_args[i] = (py_utils.NestedMap(inputs=inputs + additional),
+                       paddings_ta.read(t_read), prev_outputs)
+
+      # Input mixing of the fused sub-steps, as one batched matmul per group.
+      xmws = {}
+      for group, weights in zip(self._fused_groups, fused_weights):
+        idxs = [i for i in group if i in sub_args]
+        if len(idxs) < 2:
+          continue
+        if len(idxs) < len(group):
+          weights = tf.gather(weights, [group.index(i) for i in idxs])
+        xs = tf.stack([
+            self.sub[i].MixInputs(theta.sub[i], prepared_inputs.sub[i],
+                                  sub_args[i][0], sub_args[i][1], states[i])
+            for i in idxs
+        ])
+        xmw = tf.matmul(xs, weights)
+        for j, i in enumerate(idxs):
+          xmws[i] = xmw[j]
+
+      for i in stages:
+        sub_inputs, padding, prev_outputs = sub_args[i]
+        if i in xmws:
+          sub_output, state1_i = self.sub[i].FPropFromMix(
+              theta.sub[i], prepared_inputs.sub[i], sub_inputs, padding,
+              states[i], xmws[i])
+        else:
+          sub_output, state1_i = self._SubFProp(i, theta, prepared_inputs,
+                                                sub_inputs, padding, states[i])
+        output = sub_output.output
+        if i >= p.residual_start >= 0:
+          output += prev_outputs[p.residual_stride - 1]
+        # Sub-steps processing time steps past the end of the sequence keep
+        # their state unchanged.
+        active = tf.less(k - i, seq_len)
+        states[i] = py_utils.Transform(
+            lambda x1, x0: tf.where(active, x1, x0),  # pylint: disable=cell-var-from-loop
+            state1_i,
+            states[i])
+        if i + 1 < num_sub:
+          new_pipes[i + 1] = ((output,) + prev_outputs)[:min(i + 2, window)]
+        else:
+          top_output = output
+      return top_output, new_pipes, states
+
+    # Fills the pipeline: at tick k < len(sub) - 1, only sub-steps 0..k have
+    # an input to process.
+    pipes = [()] * num_sub
+    states = self.SubStates(state0, num_sub)
+    for k in range(num_sub - 1):
+      with _MaybeXlaJitScope(p.use_xla_jit):
+        _, pipes, states = _Tick(k, range(k + 1), pipes, states)
+
+    def _Step(k, output_ta, flat_pipes, flat_states):
+      """Runs all the sub-steps on tick k."""
+      with _MaybeXlaJitScope(p.use_xla_jit):
+        output, new_pipes, new_states = _Tick(
+            k, range(num_sub), py_utils.Pack(pipes, flat_pipes),
+            py_utils.Pack(states, flat_states))
+      output_ta = output_ta.write(k - num_sub + 1, output)
+      return (k + 1, output_ta, py_utils.Flatten(new_pipes),
+              py_utils.Flatten(new_states))
+
+    _, output_ta, _, flat_states = tf.while_loop(
+        lambda k, *_: k < seq_len + num_sub - 1,
+        _Step,
+        loop_vars=(tf.constant(num_sub - 1, tf.int32), output_ta,
+                   py_utils.Flatten(pipes), py_utils.Flatten(states)),
+        swap_memory=True)
+    state1 = self.PackSubStates(state0, py_utils.Pack(states, flat_states))
+    return py_utils.NestedMap(output=output_ta.stack()), state1
+
+
+def _HashableStructure(structure):
+  """Returns a hashable description of a nested structure, without leaves."""
+  if isinstance(structure, dict):
+    return (type(structure),) + tuple(
+        (k, _HashableStructure(structure[k])) for k in sorted(structure))
+  if isinstance(structure, (list, tuple)):
+    return (type(structure),) + tuple(_HashableStructure(x) for x in structure)
+  return None
+
+
+def _CastFloats(nested, dtype):
+  """Casts the floating point tensors of a nested structure to dtype."""
+
+  def _Cast(x):
+    if isinstance(x, (tf.Tensor, tf.Variable)) and x.dtype.is_floating:
+      return tf.cast(x, dtype)
+    return x
+
+  return py_utils.Transform(_Cast, nested)
+
+
+@contextlib.contextmanager
+def _MaybeXlaJitScope(enabled):
+  """Compiles the ops created in this scope with XLA if enabled."""
+  if enabled:
+    with tf.xla.experimental.jit_scope(compile_ops=True):
+      yield
+  else:
+    yield
+
+
+def _SwapTimeAndBatch(x):
+  """Transposes the first two dimensions of x."""
+  return tf.transpose(x, [1, 0] + list(range(2, py_utils.GetRank(x))))
+
+
+def _CudnnOpaqueParams(config, layers, direction='unidirectional'):
+  """Converts canonical LSTM weights into the opaque cuDNN parameter buffer.
+
+  Args:
+    config: A `.NestedMap` containing num_layers, num_units and input_size.
+    layers: A list of (weights, biases) tuples, as returned by
+      RnnStep.CudnnLSTMWeights, one per layer and direction, in the cuDNN
+      order (layer 0 forward, [layer 0 backward,] layer 1 forward, ...).
+    direction: 'unidirectional' or 'bidirectional'.
+
+  Returns:
+    A 1D tensor. CudnnRNNCanonicalToParamsV2 has no registered gradient, but
+    the packing only moves values around, so the gradient is unpacked from the
+    gradient of the buffer with CudnnRNNParamsToCanonicalV2.
+  """
+  weights = []
+  biases = []
+  for layer_weights, layer_biases in layers:
+    # cuDNN matrices are [num_units, input_size].
+    weights += [tf.transpose(w) for w in layer_weights]
+    biases += list(layer_biases)
+  num_weights = len(weights)
+  attrs = dict(
+      num_layers=config.num_layers,
+      num_units=config.num_units,
+      input_size=config.input_size,
+      rnn_mode='lstm',
+      input_mode='linear_input',
+      direction=direction)
+
+  @tf.custom_gradient
+  def _Pack(*canonical):
+    """Packs the weights followed by the biases into the buffer."""
+    params = tf.raw_ops.CudnnRNNCanonicalToParamsV2(
+        weights=list(canonical[:num_weights]),
+        biases=list(canonical[num_weights:]),
+        **attrs)
+
+    def _Grad(dparams):
+      dweights, dbiases = tf.raw_ops.CudnnRNNParamsToCanonicalV2(
+          params=dparams,
+          num_params_weights=num_weights,
+          num_params_biases=len(biases),
+          **attrs)
+      return list(dweights) + list(dbiases)
+
+    return params, _Grad
+
+  return _Pack(*(weights + biases))
+
+
+class BidirectionalStackStep(StackStep):
+  """A stack of bidirectional layers, run over whole sequences.
+
+  Layer i runs sub_fwd[i] forward in time and sub_bwd[i] backward in time over
+  its input, and its output is the concatenation of their outputs. The input of
+  layer 0 is the concatenation of the 'inputs' list and of the optional
+  'context'; the context is also fed to the other layers.
+
+  Since the backward direction needs the whole sequence, only FPropSequence is
+  supported. If params.use_cudnn is set and both directions are plain LSTMs of
+  the same size, the whole stack is a single bidirectional cuDNN call.
+  """
+
+  @classmethod
+  def Params(cls):
+    p = super(BidirectionalStackStep, cls).Params()
+    p.Define('sub_fwd', [], 'A list of the params of the forward sub-steps.')
+    p.Define(
+        'sub_bwd', [], 'A list of the params of the backward sub-steps. It '
+        'must have the same length as sub_fwd.')
+    return p
+
+  @base_layer.initializer
+  def __init__(self, params):
+    # These StackStep features only apply to FProp or to the sub list.
+    for name in ('fuse_homogeneous', 'skip_padded_steps', 'use_xla_jit',
+                 'stacked_state', 'cache_zero_state'):
+      if params.Get(name):
+        raise ValueError('%s is not supported.' % name)
+    if params.compute_dtype is not None:
+      raise ValueError('compute_dtype is not supported.')
+    super(BidirectionalStackStep, self).__init__(params)
+    p = self.params
+    if p.sub:
+      raise ValueError('Use sub_fwd and sub_bwd instead of sub.')
+    if len(p.sub_fwd) != len(p.sub_bwd):
+      raise ValueError('sub_fwd and sub_bwd must have the same length: '
+                       '%d vs %d.' % (len(p.sub_fwd), len(p.sub_bwd)))
+    if p.residual_start >= 0:
+      raise ValueError('Residual connections are not supported.')
+    with tf.variable_scope(p.name):
+      self.CreateChildren('sub_fwd', p.sub_fwd)
+      self.CreateChildren('sub_bwd', p.sub_bwd)
+    if p.use_cudnn:
+      self._cudnn = self._TryBuildCudnnRNN(
+          list(self.sub_fwd) + list(self.sub_bwd), num_dirs=2)
+
+  def PrepareExternalInputs(self, theta, external_inputs):
+    """Delegates external inputs preparation to sub-layers.
+
+    Args:
+      theta: A `.NestedMap` object containing weights' values of this layer and
+        its children layers.
+      external_inputs: A `.NestedMap` object. The structure of the internal
+        fields is defined by the sub-steps.
+
+    Returns:
+      A `.NestedMap` containing lists 'fwd' and 'bwd' of the pre-processed
+      versions of the external_inputs, one per sub-step.
+    """
+    return py_utils.NestedMap(
+        fwd=[
+            sub.PrepareExternalInputs(sub_theta, external_inputs)
+            for sub, sub_theta in zip(self.sub_fwd, theta.sub_fwd)
+        ],
+        bwd=[
+            sub.PrepareExternalInputs(sub_theta, external_inputs)
+            for sub, sub_theta in zip(self.sub_bwd, theta.sub_bwd)
+        ])
+
+  def ZeroState(self, theta, prepared_inputs, batch_size):
+    """Computes a zero state for each sub-step.
+
+    Args:
+      theta: A `.NestedMap` object containing weights' values of this layer and
+        its children layers.
+      prepared_inputs: An output from PrepareExternalInputs.
+      batch_size: The number of items in the batch that FPropSequence will
+        process.
+
+    Returns:
+      A `.NestedMap` containing lists 'fwd' and 'bwd' of the state0 objects of
+      the sub-steps.
+    """
+    return py_utils.NestedMap(
+        fwd=[
+            sub.ZeroState(sub_theta, sub_prepared, batch_size)
+            for sub, sub_theta, sub_prepared in zip(
+                self.sub_fwd, theta.sub_fwd, prepared_inputs.fwd)
+        ],
+        bwd=[
+            sub.ZeroState(sub_theta, sub_prepared, batch_size)
+            for sub, sub_theta, sub_prepared in zip(
+                self.sub_bwd, theta.sub_bwd, prepared_inputs.bwd)
+        ])
+
+  def FProp(self, theta, prepared_inputs, step_inputs, padding, state0):
+    raise NotImplementedError(
+        'BidirectionalStackStep only supports FPropSequence.')
+
+  def FPropPipelined(self, theta, prepared_inputs, input_batch, state0=None):
+    raise NotImplementedError(
+        'BidirectionalStackStep only supports FPropSequence.')
+
+  def FPropSequence(self,
+                    theta,
+                    prepared_inputs,
+                    input_batch,
+                    state0=None,
+                    time_major=True):
+    """Runs the bidirectional stack over a whole sequence.
+
+    Args:
+      theta: A `.NestedMap` object containing weights' values of this layer and
+        its children layers.
+      prepared_inputs: An output from PrepareExternalInputs.
+      input_batch: See StackStep.FPropSequence.
+      state0: The initial recurrent state. If None, ZeroState() is used. The
+        state of the backward sub-steps is their state before the last time
+        step of each sequence.
+      time_major: See StackStep.FPropSequence.
+
+    Returns:
+      A tuple (output, state1):
+
+      - output: A `.NestedMap` containing the [time, batch_size, ...]
+        concatenated outputs of the top-most forward and backward sub-steps.
+        If the cuDNN path is used, outputs at padded time steps are zeros.
+      - state1: The recurrent state after processing the sequences, i.e. after
+        the last time step for the forward sub-steps and after the first one
+        for the backward sub-steps.
+    """
+    if not time_major:
+      output, state1 = self.FPropSequence(
+          theta, prepared_inputs, input_batch.Transform(_SwapTimeAndBatch),
+          state0)
+      return output.Transform(_SwapTimeAndBatch), state1
+
+    paddings = input_batch.paddings
+    seq_len, batch_size = py_utils.GetShape(paddings, 2)
+    if state0 is None:
+      state0 = self.ZeroState(theta, prepared_inputs, batch_size)
+    seq_lengths = py_utils.LengthsFromPaddings(
+        tf.transpose(tf.reshape(paddings, [seq_len, batch_size])))
+
+    if self._cudnn and 'context' not in input_batch and all(
+        x is None or isinstance(x, py_utils.NestedMap)
+        for x in prepared_inputs.fwd + prepared_inputs.bwd):
+      return self._FPropSequenceCudnn(theta, input_batch, seq_lengths, state0)
+
+    def _Reverse(x):
+      return tf.reverse_sequence(x, seq_lengths, seq_axis=0, batch_axis=1)
+
+    additional = []
+    if 'context' in input_batch:
+      additional.append(input_batch.context)
+    inputs = list(input_batch.inputs)
+    state1 = py_utils.NestedMap(fwd=[], bwd=[])
+    for i in range(len(self.sub_fwd)):
+      fwd_output, fwd_state1 = self._FPropSubStepSequence(
+          self.sub_fwd[i], theta.sub_fwd[i], prepared_inputs.fwd[i],
+          inputs + additional, paddings, state0.fwd[i])
+      bwd_output, bwd_state1 = self._FPropSubStepSequence(
+          self.sub_bwd[i], theta.sub_bwd[i], prepared_inputs.bwd[i],
+          [_Reverse(x) for x in inputs + additional], _Reverse(paddings),
+          state0.bwd[i])
+      state1.fwd.append(fwd_state1)
+      state1.bwd.append(bwd_state1)
+      inputs = [tf.concat([fwd_output, _Reverse(bwd_output)], axis=2)]
+    return py_utils.NestedMap(output=inputs[0]), state1
+
+  def _FPropSubStepSequence(self, sub, theta, prepared_inputs, inputs, paddings,
+                            state0):
+    """Runs a single sub-step over [time, batch_size, ...] inputs."""
+    inputs_ta, paddings_ta = self._UnstackInputBatch(
+        py_utils.NestedMap(inputs=inputs, paddings=paddings))
+    seq_len = py_utils.GetShape(paddings, 1)[0]
+    return self._FPropLoop(
+        lambda *args: sub.FProp(theta, prepared_inputs, *args), inputs_ta,
+        paddings_ta, state0, seq_len)
+
+  def _FPropSequenceCudnn(self, theta, input_batch, seq_lengths, state0):
+    """FPropSequence implementation running the stack as one cuDNN LSTM."""
+    # cuDNN orders the layers as (layer 0 fwd, layer 0 bwd, layer 1 fwd, ...).
+    num_layers = self._cudnn.num_layers
+    layers = []
+    states = []
+    for i in range(num_layers):
+      layers.append(self.sub_fwd[i].CudnnLSTMWeights(theta.sub_fwd[i]))
+      layers.append(self.sub_bwd[i].CudnnLSTMWeights(theta.sub_bwd[i]))
+      states += [state0.fwd[i], state0.bwd[i]]
+    result = tf.raw_ops.CudnnRNNV3(
+        input=tf.concat(input_batch.inputs, axis=2),
+        input_h=tf.stack([s.m for s in states]),
+        input_c=tf.stack([s.c for s in states]),
+        params=_CudnnOpaqueParams(self._cudnn, layers, 'bidirectional'),
+        sequence_lengths=seq_lengths,
+        rnn_mode='lstm',
+        input_mode='linear_input',
+        direction='bidirectional',
+        is_training=not self.do_eval,
+        time_major=True)
+    states1 = [
+        py_utils.NestedMap(m=m, c=c)
+        for m, c in zip(
+            tf.unstack(result.output_h, num=2 * num_layers),
+            tf.unstack(result.output_c, num=2 * num_layers))
+    ]
+    state1 = py_utils.NestedMap(fwd=states1[0::2], bwd=states1[1::2])
+    return py_utils.NestedMap(output=result.output), state1
 
 
 class ParallelStep(Step):
@@ -372,7 +1420,7 @@ SubStep = collections.namedtuple('SubStep',
                                  ['signature', 'external_signature', 'params'])
 
 
-class GraphStep(Step):
+class GraphStep(ZeroStateCache, Step):
   r"""A step that connects sub-steps in a simple data flow graph.
 
   This is an adaptation of builder_layers.GraphLayer to support steps.
@@ -383,9 +1431,9 @@ class GraphStep(Step):
 
     * step_inputs: The signature describing how to assemble the input and output
       for this step. The input part describes the 'step_inputs' parameter,
-      while the output part describes the name of the output. The state0
-      input and state1 output are handled automatically and should not be
-      specified.
+      while the output part describes the name of the output, which must not
+      contain dots. The state0 input and state1 output are handled
+      automatically and should not be specified.
     * external_inputs: if this Step requires external_inputs, this
       is the signature describing how to find those inputs.
       This value can also be set to None.
@@ -416,16 +1464,50 @@ class GraphStep(Step):
     p.Define('output_signature', '', 'Signature of the step output.')
     p.Define('sub', [], 'A list of SubSteps (defined above).')
     p.Define('dict_type', py_utils.NestedMap, 'Type of nested dicts.')
+    p.Define(
+        'use_tf_function', False, 'If True, FProp is traced into a '
+        'concrete tf.function once per input signature and later calls '
+        'reuse it. Only applies when all the inputs of FProp are tensors.')
+    p.Define(
+        'use_xla_jit', False, 'If True, the ops of FProp are compiled with '
+        'XLA, which fuses the small per-step ops into fewer kernels. With '
+        'use_tf_function, the traced function is compiled as a whole. The '
+        'loop over time steps must stay outside of FProp, so the sequence '
+        'length may be dynamic.')
+    p.Define(
+        'share_external_prep', False, 'If True, sub-steps of the same class '
+        'with the same external_inputs signature share the result of a '
+        'single PrepareExternalInputs call, made by the first of them. Only '
+        'set this if their PrepareExternalInputs compute the same values, '
+        'e.g. if they do not depend on the weights of the sub-step.')
+    p.Define(
+        'cache_zero_state', False, 'If True, ZeroState caches its result for '
+        'static batch sizes, and returns it again for the same batch size, '
+        'graph, weights and prepared inputs. The cached state must only be '
+        'used where the first one could be used, e.g. not across '
+        'control flow contexts.')
     return p
 
-  _seq = collections.namedtuple(
-      '_Seq', ['name', 'signature', 'external_signature', 'step'])
+  # The step_inputs and external_inputs of the sub-step are assembled by
+  # packing the values of input_refs (resp. external_refs) into
+  # input_structure (resp. external_structure). The refs are the flat lists of
+  # (slot index, keys) references described in _SlotRef. output_idx is the
+  # index of the slot in which the sub-step output is stored.
+  _seq = collections.namedtuple('_Seq', [
+      'name', 'signature', 'external_signature', 'step', 'input_structure',
+      'input_refs', 'external_structure', 'external_refs', 'output_idx'
+  ])
 
   @base_layer.initializer
   def __init__(self, params):
     super(GraphStep, self).__init__(params)
     p = self.params
     assert p.name
+    # Tensors available to the sub-steps are kept in a list of slots during
+    # FProp. Each named tensor is assigned a slot index here, so that no name
+    # lookup is needed while running the step.
+    name_to_idx = {'prepared_inputs': 0, 'step_inputs': 1}
+    external_name_to_idx = {'external_inputs': 0}
     with tf.variable_scope(p.name):
       self._seq = []
       for i, (signature, external_signature, sub_params) in enumerate(p.sub):
@@ -434,18 +1516,115 @@ class GraphStep(Step):
         assert len(sig.inputs) == 1
         assert sig.outputs
         external_sig = None
+        external_structure, external_refs = None, []
         if external_signature:
           external_sig = builder_layers.GraphSignature(external_signature)
           assert len(external_sig.inputs) == 1
           assert not external_sig.outputs
+          external_structure, external_refs = self._FlattenSignature(
+              external_name_to_idx, external_sig.inputs[0])
+        input_structure, input_refs = self._FlattenSignature(
+            name_to_idx, sig.inputs[0])
+        output_name = sig.outputs[0]
+        if '.' in output_name:
+          # The outputs are stored in flat slots, so a dotted name could not
+          # be read back through its prefix.
+          raise ValueError('Output name "%s" must not contain dots.' %
+                           output_name)
+        if output_name in name_to_idx:
+          raise ValueError('A tensor named "%s" already exists.' % output_name)
+        output_idx = len(name_to_idx)
+        name_to_idx[output_name] = output_idx
         name = sub_params.name
         if not name:
-          name = '%s_%02d' % (sig.outputs[0], i)
+          name = '%s_%02d' % (output_name, i)
           sub_params.name = name
+        name = intern(name)
         self.CreateChild(name, sub_params)
         self._seq.append(
-            GraphStep._seq(name, sig, external_sig, self.children[name]))
+            GraphStep._seq(name, sig, external_sig, self.children[name],
+                           input_structure, input_refs, external_structure,
+                           external_refs, output_idx))
       self.output_signature = builder_layers.GraphSignature(p.output_signature)
+      self._output_structure, self._output_refs = self._FlattenSignature(
+          name_to_idx, self.output_signature.inputs[0])
+      # The output signature usually names the output of one of the sub-steps;
+      # its slot is then returned as is.
+      self._output_idx = None
+      if self._output_structure is None and not self._output_refs[0][1]:
+        self._output_idx = self._output_refs[0][0]
+      self._seq_names = [seq.name for seq in self._seq]
+      # Groups of the indices of the sub-steps with external inputs, as a list
+      # of (key, indices). PrepareExternalInputs is called once per group.
+      groups = collections.OrderedDict()
+      for i, seq in enumerate(self._seq):
+        if not seq.external_signature:
+          continue
+        key = i
+        if p.share_external_prep:
+          key = (str(seq.external_signature.inputs), type(seq.step))
+        groups.setdefault(key, []).append(i)
+      self._ext_groups = list(groups.items())
+      self._num_slots = len(name_to_idx)
+    # Maps the structure and flat TensorSpecs of the inputs of FProp to a
+    # tuple (concrete function, outputs structure).
+    self._fprop_fns = {}
+
+  @staticmethod
+  def _SlotRef(name_to_idx, path):
+    """Resolves a signature path into a reference to a slot.
+
+    Args:
+      name_to_idx: A dict from tensor names to slot indices.
+      path: A path into the named tensors, e.g. 'step_inputs.a'.
+
+    Returns:
+      A tuple (slot index, keys), where keys is the tuple of keys to follow
+      from the tensor in the slot to the value of the path.
+
+    Raises:
+      ValueError: if path does not refer to a known tensor.
+    """
+    names = path.strip().split('.')
+    for i in range(len(names), 0, -1):
+      idx = name_to_idx.get('.'.join(names[:i]))
+      if idx is not None:
+        return idx, tuple(names[i:])
+    raise ValueError('%s not found in %s' % (path, sorted(name_to_idx)))
+
+  @classmethod
+  def _FlattenSignature(cls, name_to_idx, signature_input):
+    """Resolves the paths of a signature input into a flat list of references.
+
+    Args:
+      name_to_idx: A dict from tensor names to slot indices.
+      signature_input: A signature input, i.e. a path, or a nested structure
+        of paths.
+
+    Returns:
+      A tuple (structure, refs), where refs is the list of the references
+      returned by _SlotRef for the flattened paths of signature_input, and
+      structure can be used with py_utils.Pack to rebuild signature_input from
+      the values of refs.
+    """
+    # Only NestedMaps and lists are structures in a signature.
+    template = py_utils.NestedMap(x=signature_input)
+    refs = [cls._SlotRef(name_to_idx, path) for path in template.Flatten()]
+    return template.Transform(lambda _: None).x, refs
+
+  @staticmethod
+  def _ReadSlot(slots, ref):
+    """Returns the value referred to by a reference from _SlotRef."""
+    idx, keys = ref
+    value = slots[idx]
+    for key in keys:
+      value = value[key]
+    return value
+
+  @classmethod
+  def _ReadSlots(cls, slots, structure, refs):
+    """Packs the values referred to by refs into structure."""
+    return py_utils.Pack(structure, [cls._ReadSlot(slots, ref) for ref in refs])
 
   def PrepareExternalInputs(self, theta, external_inputs):
     """Prepares external inputs for each sub-step.
@@ -462,20 +1641,18 @@ class GraphStep(Step):
       A NestedMap of prepared inputs, where the keys are the names of
         each sub-step.
     """
-    graph_tensors = builder_layers.GraphTensors()
-    graph_tensors.StoreTensor('external_inputs', external_inputs)
-    prepared_inputs = py_utils.NestedMap()
+    slots = [external_inputs]
+    prepared_inputs = [py_utils.NestedMap() for _ in self._seq]
     with tf.name_scope(self.params.name):
-      for seq in self._seq:
-        if seq.external_signature:
-          template = py_utils.NestedMap(inputs=seq.external_signature.inputs)
-          packed = template.Transform(graph_tensors.GetTensor)
-          seq_external_inputs = packed.inputs[0]
-          prepared_inputs[seq.name] = seq.step.PrepareExternalInputs(
-              theta[seq.name], seq_external_inputs)
-        else:
-          prepared_inputs[seq.name] = py_utils.NestedMap()
-    return prepared_inputs
+      for _, idxs in self._ext_groups:
+        seq = self._seq[idxs[0]]
+        seq_external_inputs = self._ReadSlots(slots, seq.external_structure,
+                                              seq.external_refs)
+        prepared = seq.step.PrepareExternalInputs(theta[seq.name],
+                                                  seq_external_inputs)
+        for i in idxs:
+          prepared_inputs[i] = prepared
+    return py_utils.NestedMap(zip(self._seq_names, prepared_inputs))
 
   def ZeroState(self, theta, prepared_inputs, batch_size):
     """Creates a zero state NestedMap for this step.
@@ -488,13 +1665,18 @@ class GraphStep(Step):
     Returns:
       A NestedMap of ZeroState results for each sub-step.
     """
-    state0 = py_utils.NestedMap()
+    if self.params.cache_zero_state:
+      return self._CachedZeroState(theta, prepared_inputs, batch_size)
+    return self._ZeroState(theta, prepared_inputs, batch_size)
+
+  def _ZeroState(self, theta, prepared_inputs, batch_size):
+    """Implementation of ZeroState, see ZeroState for the arguments."""
     with tf.name_scope(self.params.name):
-      for seq in self._seq:
-        state0[seq.name] = seq.step.ZeroState(theta[seq.name],
-                                              prepared_inputs[seq.name],
-                                              batch_size)
-    return state0
+      state0 = [
+          seq.step.ZeroState(theta[seq.name], prepared_inputs[seq.name],
+                             batch_size) for seq in self._seq
+      ]
+    return py_utils.NestedMap(zip(self._seq_names, state0))
 
   def FProp(self, theta, prepared_inputs, step_inputs, padding, state0):
     """A single inference step for this step graph.
@@ -520,26 +1702,62 @@ class GraphStep(Step):
       are state outputs from their FProp methods.
     """
     p = self.params
-    graph_tensors = builder_layers.GraphTensors()
-    graph_tensors.StoreTensor('prepared_inputs', prepared_inputs)
-    graph_tensors.StoreTensor('step_inputs', step_inputs)
-    state1 = py_utils.NestedMap()
+    args = (theta, prepared_inputs, step_inputs, padding, state0)
+    flat_args = py_utils.Flatten(args)
+    if not p.use_tf_function or not all(
+        isinstance(x, tf.Tensor) for x in flat_args):
+      with _MaybeXlaJitScope(p.use_xla_jit):
+        return self._FPropImpl(*args)
+
+    # The structures are kept with None leaves, so that the cache does not
+    # hold on to the tensors of the first call.
+    args_structure = py_utils.Transform(lambda _: None, args)
+    specs = tuple(tf.TensorSpec(x.shape, x.dtype) for x in flat_args)
+    key = (_HashableStructure(args_structure), specs)
+    if key not in self._fprop_fns:
+      outputs_structure = []
+
+      def _FlatFProp(*flat_inputs):
+        outputs = self._FPropImpl(*py_utils.Pack(args_structure, flat_inputs))
+        outputs_structure.append(py_utils.Transform(lambda _: None, outputs))
+        return py_utils.Flatten(outputs)
+
+      fn = tf.function(
+          _FlatFProp,
+          input_signature=specs,
+          experimental_compile=p.use_xla_jit).get_concrete_function()
+      self._fprop_fns[key] = (fn, outputs_structure[0])
+    fn, outputs_structure = self._fprop_fns[key]
+    return py_utils.Pack(outputs_structure, fn(*flat_args))
+
+  def _FPropImpl(self, theta, prepared_inputs, step_inputs, padding, state0):
+    """Implementation of FProp, see FProp for the arguments."""
+    p = self.params
+    slots = [None] * self._num_slots
+    slots[0] = prepared_inputs
+    slots[1] = step_inputs
+    # The NestedMaps keyed by sub-step names only exist at the API boundary;
+    # the sub-steps are run on lists in the order of self._seq.
+    state0 = [state0[name] for name in self._seq_names]
+    state1 = []
     with tf.name_scope(p.name):
-      for seq in self._seq:
+      for seq, seq_state0 in zip(self._seq, state0):
         tf.logging.vlog(1, 'GraphStep: call %s', seq.name)
         external = None
         if seq.external_signature:
           external = prepared_inputs[seq.name]
-        template = py_utils.NestedMap(inputs=seq.signature.inputs)
-        packed = template.Transform(graph_tensors.GetTensor)
-        input_args = packed.inputs[0]
+        input_args = self._ReadSlots(slots, seq.input_structure,
+                                     seq.input_refs)
         out, seq_state1 = seq.step.FProp(theta[seq.name], external, input_args,
-                                         padding, state0[seq.name])
-        graph_tensors.StoreTensor(seq.signature.outputs[0], out)
-        state1[seq.name] = seq_state1
-    template = py_utils.NestedMap(inputs=self.output_signature.inputs)
-    output_tensors = template.Transform(graph_tensors.GetTensor).inputs[0]
-    return output_tensors, state1
+                                         padding, seq_state0)
+        slots[seq.output_idx] = out
+        state1.append(seq_state1)
+    if self._output_idx is not None:
+      output_tensors = slots[self._output_idx]
+    else:
+      output_tensors = self._ReadSlots(slots, self._output_structure,
+                                       self._output_refs)
+    return output_tensors, py_utils.NestedMap(zip(self._seq_names, state1))
 
 
 class IteratorStep(Step):
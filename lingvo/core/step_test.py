@@ -57,6 +57,25 @@ class TextStep(step.Step):
             state0 + ':'.join(step_inputs.inputs))
 
 
+class SumStep(step.Step):
+  """SumStep is a fake numeric step used for testing.
+
+  Its output is the sum of its inputs and of its state, which counts the
+  number of calls to FProp.
+  """
+
+  def PrepareExternalInputs(self, theta, external_inputs):
+    return py_utils.NestedMap()
+
+  def ZeroState(self, theta, prepared_inputs, batch_size):
+    return py_utils.NestedMap(count=tf.zeros([batch_size], tf.float32))
+
+  def FProp(self, theta, external_inputs, step_inputs, padding, state0):
+    return py_utils.NestedMap(
+        output=tf.add_n(step_inputs.inputs + [state0.count])), (
+            py_utils.NestedMap(count=state0.count + 1.0))
+
+
 class StepTest(test_utils.TestCase):
 
   def testStatelessLayerStep(self):
@@ -105,6 +124,152 @@ class StepTest(test_utils.TestCase):
     self.assertEqual({'output': 'aa:1step0:2step1'}, output)
     self.assertEqual({'step1': 'step1aa:1step0', 'step0': 'step0aa'}, state1)
 
+  def testGraphStepShareExternalPrep(self):
+    p = step.GraphStep.Params()
+    p.name = 'graphtest'
+    p.sub = [
+        ('(inputs=[step_inputs.a])->output0', 'external_inputs.x',
+         TextStep.Params().Set(name='step0')),
+        ('(inputs=[output0.output])->output1', 'external_inputs.y',
+         TextStep.Params().Set(name='step1')),
+        ('(inputs=[output1.output])->output2', 'external_inputs.x',
+         TextStep.Params().Set(name='step2')),
+    ]
+    p.output_signature = 'output2'
+    p.share_external_prep = True
+    s = p.Instantiate()
+    self.assertEqual([[0, 2], [1]], [idxs for _, idxs in s._ext_groups])  # pylint: disable=protected-access
+
+    prepared = s.PrepareExternalInputs(s.theta,
+                                       py_utils.NestedMap(x='1', y='2'))
+    self.assertEqual({'step0': '1', 'step1': '2', 'step2': '1'}, prepared)
+
+  def testGraphStepCacheZeroState(self):
+    with self.session():
+      p = step.GraphStep.Params()
+      p.name = 'graphtest'
+      p.sub = [
+          ('(inputs=[step_inputs.a])->output0', None,
+           SumStep.Params().Set(name='step0')),
+      ]
+      p.output_signature = 'output0'
+      p.cache_zero_state = True
+      s = p.Instantiate()
+
+      prepared = s.PrepareExternalInputs(s.theta, py_utils.NestedMap())
+      state0 = s.ZeroState(s.theta, prepared, 2)
+      self.assertIs(state0, s.ZeroState(s.theta, prepared, 2))
+      self.assertIs(state0, s.ZeroState(s.theta, prepared, tf.constant(2)))
+      self.assertIsNot(state0, s.ZeroState(s.theta, prepared, 3))
+      self.assertIsNot(state0,
+                       s.ZeroState(s.theta, prepared,
+                                   tf.placeholder_with_default(2, [])))
+
+    # The cache is cleared in another graph, and no longer refers to the
+    # states of the previous one.
+    with tf.Graph().as_default():
+      prepared = s.PrepareExternalInputs(s.theta, py_utils.NestedMap())
+      self.assertIsNot(state0, s.ZeroState(s.theta, prepared, 2))
+      self.assertLen(s._zero_state_cache, 1)  # pylint: disable=protected-access
+
+  def testGraphStepTfFunction(self):
+    with self.session() as sess:
+      p = step.GraphStep.Params()
+      p.name = 'graphtest'
+      p.sub = [
+          ('(inputs=[step_inputs.a])->output0', None,
+           SumStep.Params().Set(name='step0')),
+          ('(inputs=[output0.output,step_inputs.b])->output1', None,
+           SumStep.Params().Set(name='step1')),
+      ]
+      p.output_signature = 'output1'
+      p.use_tf_function = True
+      s = p.Instantiate()
+
+      prepared = s.PrepareExternalInputs(s.theta, py_utils.NestedMap())
+      state = s.ZeroState(s.theta, prepared, 2)
+      step_inputs = py_utils.NestedMap(
+          a=tf.constant([1.0, 2.0]), b=tf.constant([3.0, 4.0]))
+      outputs = []
+      for _ in range(2):
+        output, state = s.FProp(s.theta, prepared, step_inputs, tf.zeros([2]),
+                                state)
+        outputs.append(output.output)
+      # The FProp graph is traced only once.
+      self.assertLen(s._fprop_fns, 1)  # pylint: disable=protected-access
+      # The same flat inputs in a different structure are traced again.
+      step_inputs.c = []
+      output, _ = s.FProp(s.theta, prepared, step_inputs, tf.zeros([2]), state)
+      outputs.append(output.output)
+      self.assertLen(s._fprop_fns, 2)  # pylint: disable=protected-access
+      self.assertAllClose([[4.0, 6.0], [6.0, 8.0], [8.0, 10.0]],
+                          sess.run(outputs))
+
+  def testGraphStepXlaJit(self):
+    with self.session():
+      p = step.GraphStep.Params()
+      p.name = 'graphtest'
+      p.sub = [
+          ('(inputs=[step_inputs.a,step_inputs.b])->output0', None,
+           SumStep.Params().Set(name='step0')),
+      ]
+      p.output_signature = 'output0'
+      p.use_xla_jit = True
+      s = p.Instantiate()
+
+      prepared = s.PrepareExternalInputs(s.theta, py_utils.NestedMap())
+      state = s.ZeroState(s.theta, prepared, 2)
+      step_inputs = py_utils.NestedMap(
+          a=tf.constant([1.0, 2.0]), b=tf.constant([3.0, 4.0]))
+      output, _ = s.FProp(s.theta, prepared, step_inputs, tf.zeros([2]), state)
+      self.assertTrue(output.output.op.get_attr('_XlaCompile'))
+
+      # With use_tf_function, the traced function is compiled as a whole.
+      p.use_tf_function = True
+      s = p.Instantiate()
+      s.FProp(s.theta, prepared, step_inputs, tf.zeros([2]), state)
+      (fn, _), = s._fprop_fns.values()  # pylint: disable=protected-access
+      self.assertTrue(fn.function_def.attr['_XlaMustCompile'].b)
+
+  def testGraphStepDuplicateOutputName(self):
+    p = step.GraphStep.Params()
+    p.name = 'graphtest'
+    p.sub = [
+        ('(inputs=[step_inputs.a])->output0', 'external_inputs.x',
+         TextStep.Params().Set(name='step0')),
+        ('(inputs=[output0.output])->output0', 'external_inputs.y',
+         TextStep.Params().Set(name='step1')),
+    ]
+    p.output_signature = 'output0'
+    with self.assertRaisesRegex(ValueError, 'already exists'):
+      p.Instantiate()
+
+  def testGraphStepDottedOutputName(self):
+    p = step.GraphStep.Params()
+    p.name = 'graphtest'
+    p.sub = [
+        ('(inputs=[step_inputs.a])->out.a', 'external_inputs.x',
+         TextStep.Params().Set(name='step0')),
+        ('(inputs=[out])->output1', 'external_inputs.y',
+         TextStep.Params().Set(name='step1')),
+    ]
+    p.output_signature = 'output1'
+    with self.assertRaisesRegex(ValueError, 'must not contain dots'):
+      p.Instantiate()
+
+  def testGraphStepUnknownInputName(self):
+    p = step.GraphStep.Params()
+    p.name = 'graphtest'
+    p.sub = [
+        ('(inputs=[output1.output])->output0', 'external_inputs.x',
+         TextStep.Params().Set(name='step0')),
+        ('(inputs=[step_inputs.a])->output1', 'external_inputs.y',
+         TextStep.Params().Set(name='step1')),
+    ]
+    p.output_signature = 'output1'
+    with self.assertRaisesRegex(ValueError, 'output1.output not found'):
+      p.Instantiate()
+
   def testStackStep(self):
     p = step.StackStep.Params()
     p.name = 'stack'
@@ -137,6 +302,29 @@ class StepTest(test_utils.TestCase):
     self.assertEqual(
         {'sub': ['text0in', 'text1in:ztext0', 'text2in:ztext0:ztext1']}, state1)
 
+  def testStackStepInvalidResidualStride(self):
+    p = step.StackStep.Params()
+    p.name = 'stack'
+    p.sub = [
+        TextStep.Params().Set(name='text0'),
+        TextStep.Params().Set(name='text1'),
+    ]
+    p.residual_start = 0
+    p.residual_stride = 2
+    with self.assertRaisesRegex(ValueError, 'residual_start'):
+      p.Instantiate()
+
+  def testStackStepSkipPaddedStepsUnsupported(self):
+    p = step.StackStep.Params()
+    p.name = 'stack'
+    p.sub = [
+        TextStep.Params().Set(name='text0'),
+        TextStep.Params().Set(name='text1'),
+    ]
+    p.skip_padded_steps = True
+    with self.assertRaisesRegex(ValueError, 'text0 to keep its state'):
+      p.Instantiate()
+
   def testStackStepWithResidualConnections(self):
     p = step.StackStep.Params()
     p.name = 'stack'
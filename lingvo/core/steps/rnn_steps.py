@@ -94,15 +94,158 @@ class RnnStep(step.Step):
       of shape [batch_size, p.cell.num_output_nodes], and state1 is the cell's
       recurrent state.
     """
-    cell_inputs = py_utils.NestedMap(act=step_inputs.inputs)
+    cell_inputs = self._CellInputs(prepared_inputs, step_inputs, padding)
+    state1, extra = self.cell.FProp(theta.cell, state0, cell_inputs)
+    return py_utils.NestedMap(
+        output=self.cell.GetOutput(state1), extra=extra,
+        padding=padding), state1
+
+  def _CellInputs(self, prepared_inputs, step_inputs, padding):
+    """Returns the inputs NestedMap for the RNN cell."""
+    cell_inputs = py_utils.NestedMap(act=list(step_inputs.inputs))
     # An empty NestedMap can act as a None value here.
     if prepared_inputs is not None and not isinstance(prepared_inputs,
                                                       py_utils.NestedMap):
       cell_inputs.act.append(prepared_inputs)
     cell_inputs.padding = padding
-    state1, extra = self.cell.FProp(theta.cell, state0, cell_inputs)
+    return cell_inputs
+
+  def KeepsStateOnPadding(self):
+    """Returns whether FProp returns state0 where the padding is 1.
+
+    RNN cells carry over their state on padded time steps. See
+    StackStep.Params().skip_padded_steps.
+    """
+    return True
+
+  def PassThroughOutput(self, theta, prepared_inputs, state0):
+    """Returns the output of FProp on a time step where the batch is padded.
+
+    The cell keeps its state on padded time steps, so this is the output of
+    state0, and it can be computed without running the cell.
+
+    Args:
+      theta: Variables used by the RNNCell.
+      prepared_inputs: unused.
+      state0: See FProp.
+
+    Returns:
+      A [batch_size, p.cell.num_output_nodes] tensor.
+    """
+    del theta, prepared_inputs
+    return self.cell.GetOutput(state0)
+
+  def SupportsReducedPrecision(self):
+    """Returns whether FProp can run with all its inputs in a reduced precision.
+
+    This is the case if the cell computes all its values from its inputs,
+    weights and state, so that they all have the dtype of these. See
+    StackStep.Params().compute_dtype.
+    """
+    cp = self.cell.params
+    # _GetBias creates its adjustments in the dtype of the params.
+    return (type(self.cell) is rnn_cell.LSTMCellSimple and  # pylint: disable=unidiomatic-typecheck
+            cp.enable_lstm_bias and cp.forget_gate_bias == 0.0 and
+            cp.zo_prob == 0.0 and not cp.apply_pruning and
+            cp.qdomain.default is None)
+
+  def CudnnLSTMShape(self):
+    """Returns the (input_size, num_units) of the cell as a cuDNN LSTM.
+
+    Returns:
+      None if the cell does not compute the same function as a cuDNN LSTM.
+    """
+    cp = self.cell.params
+    if (type(self.cell) is not rnn_cell.LSTMCellSimple or  # pylint: disable=unidiomatic-typecheck
+        cp.num_hidden_nodes or cp.cell_value_cap is not None or
+        not cp.output_nonlinearity or cp.zo_prob > 0.0 or
+        cp.couple_input_forget_gates or cp.apply_pruning or
+        cp.reset_cell_state or cp.qdomain.default is not None):
+      return None
+    return cp.num_input_nodes, cp.num_output_nodes
+
+  def CudnnLSTMWeights(self, theta):
+    """Returns the cell weights in the canonical cuDNN LSTM layout.
+
+    Only valid if CudnnLSTMShape() is not None. The cuDNN LSTM state h and c
+    correspond to the m and c fields of the cell state.
+
+    Args:
+      theta: Variables used by the RNNCell.
+
+    Returns:
+      A tuple (weights, biases). weights is the list of the 4 input and the 4
+      recurrent [input_size, num_units] and [num_units, num_units] matrices,
+      and biases the list of the 8 corresponding [num_units] vectors, all in
+      the cuDNN gate order (input, forget, cell, output).
+    """
+    wm = self.cell.QWeight(theta.cell.wm)
+    b = self.cell._GetBias(theta.cell)  # pylint: disable=protected-access
+    # The gates of LSTMCellSimple are ordered (cell, input, forget, output).
+    order = [1, 2, 0, 3]
+    input_size = self.cell.params.num_input_nodes
+    w_gates = tf.split(wm, 4, axis=1)
+    b_gates = tf.split(b, 4, axis=0)
+    weights = ([w_gates[g][:input_size] for g in order] +
+               [w_gates[g][input_size:] for g in order])
+    biases = [b_gates[g] for g in order] + [tf.zeros_like(b_gates[0])] * 4
+    return weights, biases
+
+  def FusableMixShape(self):
+    """Returns the shape of the cell's input mixing weights.
+
+    The input mixing of the cell is tf.matmul(MixInputs(...), MixWeights(...)).
+    StackStep can compute it for several sub-steps with weights of the same
+    shape in one batched matmul, then call FPropFromMix on each of them.
+
+    Returns:
+      A tuple, or None if the cell does not support computing its input
+      mixing separately.
+    """
+    cp = self.cell.params
+    if (not isinstance(self.cell, rnn_cell.LSTMCellSimple) or
+        cp.apply_pruning or cp.reset_cell_state):
+      return None
+    return tuple(self.cell.vars.wm.shape.as_list())
+
+  def MixWeights(self, theta):
+    """Returns the [input_dim, num_gates * hidden_dim] mixing weights."""
+    return self.cell.QWeight(theta.cell.wm)
+
+  def MixInputs(self, theta, prepared_inputs, step_inputs, padding, state0):
+    """Returns the [batch_size, input_dim] left operand of the input mixing.
+
+    Args:
+      theta: Variables used by the RNNCell.
+      prepared_inputs: See FProp.
+      step_inputs: See FProp.
+      padding: See FProp.
+      state0: See FProp.
+    """
+    del theta
+    cell_inputs = self._CellInputs(prepared_inputs, step_inputs, padding)
+    return tf.concat(cell_inputs.act + [state0.m], 1)
+
+  def FPropFromMix(self, theta, prepared_inputs, step_inputs, padding, state0,
+                   xmw):
+    """Same as FProp, given the input mixing result.
+
+    Args:
+      theta: Variables used by the RNNCell.
+      prepared_inputs: See FProp.
+      step_inputs: See FProp.
+      padding: See FProp.
+      state0: See FProp.
+      xmw: tf.matmul(MixInputs(...), MixWeights(...)).
+
+    Returns:
+      (output, state1), see FProp.
+    """
+    cell_inputs = self._CellInputs(prepared_inputs, step_inputs, padding)
+    state1 = self.cell._Gates(xmw, theta.cell, state0, cell_inputs)  # pylint: disable=protected-access
     return py_utils.NestedMap(
-        output=self.cell.GetOutput(state1), extra=extra,
+        output=self.cell.GetOutput(state1),
+        extra=py_utils.NestedMap(),
         padding=padding), state1
 
 
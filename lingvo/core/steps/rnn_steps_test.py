@@ -23,6 +23,8 @@ from lingvo.core import py_utils
 from lingvo.core import step
 from lingvo.core import test_utils
 from lingvo.core.steps import rnn_steps
+import numpy as np
+from six.moves import range
 
 
 class RnnStepsTest(test_utils.TestCase):
@@ -232,6 +234,339 @@ class RnnStepsTest(test_utils.TestCase):
               }]
           })
 
+  def _StackStepAndInputs(self,
+                          rnn_layers=2,
+                          cell_value_cap=10.0,
+                          forget_gate_bias=0.0,
+                          **stack_params):
+    """Returns a StackStep of RnnSteps and a [time, batch, dim] input batch."""
+    p = step.StackStep.Params().Set(name='stack', **stack_params)
+    p.sub = []
+    for i in range(rnn_layers):
+      sub = rnn_steps.RnnStep.Params()
+      sub.name = 'rnn_%d' % i
+      sub.cell.params_init = py_utils.WeightInit.Uniform(1.24, 429891685)
+      sub.cell.bias_init = py_utils.WeightInit.Uniform(1.24, 429891685)
+      sub.cell.vn.global_vn = False
+      sub.cell.vn.per_step_vn = False
+      sub.cell.num_input_nodes = 3
+      sub.cell.num_output_nodes = 3
+      sub.cell.cell_value_cap = cell_value_cap
+      sub.cell.forget_gate_bias = forget_gate_bias
+      p.sub.append(sub)
+    stack = p.Instantiate()
+
+    np.random.seed(12345)
+    inputs = tf.constant(np.random.uniform(size=[4, 2, 3]), tf.float32)
+    paddings = tf.constant([[[0.], [0.]], [[0.], [0.]], [[0.], [1.]],
+                            [[1.], [1.]]], tf.float32)
+    return stack, py_utils.NestedMap(inputs=[inputs], paddings=paddings)
+
+  def _FPropStepByStep(self, stack, prepared, input_batch):
+    """Runs stack.FProp once per time step, from Python."""
+    state = stack.ZeroState(stack.theta, prepared, 2)
+    outputs = []
+    for t in range(4):
+      output, state = stack.FProp(
+          stack.theta, prepared,
+          py_utils.NestedMap(inputs=[input_batch.inputs[0][t]]),
+          input_batch.paddings[t], state)
+      outputs.append(output.output)
+    return py_utils.NestedMap(output=tf.stack(outputs)), state
+
+  def testStackStepFPropSequence(self):
+    with self.session(use_gpu=False) as sess:
+      stack, input_batch = self._StackStepAndInputs(residual_start=0)
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      expected = self._FPropStepByStep(stack, prepared, input_batch)
+      actual = stack.FPropSequence(stack.theta, prepared, input_batch)
+
+      tf.global_variables_initializer().run()
+      expected, actual = sess.run([expected, actual])
+      self.assertAllClose(expected, actual)
+
+  def testStackStepFPropSequenceBatchMajor(self):
+    with self.session(use_gpu=False) as sess:
+      stack, input_batch = self._StackStepAndInputs(residual_start=0)
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      expected = self._FPropStepByStep(stack, prepared, input_batch)
+      batch_major = input_batch.Transform(
+          lambda x: tf.transpose(x, [1, 0, 2]))
+      output, state1 = stack.FPropSequence(
+          stack.theta, prepared, batch_major, time_major=False)
+      step_inputs = stack.SliceInputsForStep(batch_major, 2)
+
+      tf.global_variables_initializer().run()
+      expected, actual, step_inputs, inputs = sess.run(
+          [expected, (output, state1), step_inputs, input_batch])
+      self.assertAllClose(expected[0].output,
+                          np.transpose(actual[0].output, [1, 0, 2]))
+      self.assertAllClose(expected[1], actual[1])
+      self.assertAllClose(inputs.inputs[0][2], step_inputs.inputs[0])
+
+  def testStackStepSkipPaddedSteps(self):
+    with self.session(use_gpu=False) as sess:
+      stack, input_batch = self._StackStepAndInputs(
+          residual_start=0, skip_padded_steps=True)
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      expected = self._FPropStepByStep(stack, prepared, input_batch)
+      actual = stack.FPropSequence(stack.theta, prepared, input_batch)
+
+      tf.global_variables_initializer().run()
+      expected, actual = sess.run([expected, actual])
+      self.assertAllClose(expected[1], actual[1])
+      self.assertAllClose(expected[0].output[:3], actual[0].output[:3])
+      # The last time step is fully padded: FProp passes the output of the
+      # top-most state through, and FPropSequence does not run it.
+      self.assertAllClose(expected[1].sub[1].m, expected[0].output[3])
+      self.assertAllClose(np.zeros([2, 3]), actual[0].output[3])
+
+  def testStackStepStackedState(self):
+    with self.session(use_gpu=False) as sess:
+      stack, input_batch = self._StackStepAndInputs(residual_start=0)
+      stacked, _ = self._StackStepAndInputs(
+          residual_start=0, stacked_state=True)
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      state0 = stacked.ZeroState(stack.theta, prepared, 2)
+      self.assertIn('stacked', state0)
+      expected = self._FPropStepByStep(stack, prepared, input_batch)
+      output, state1 = stacked.FPropSequence(stack.theta, prepared, input_batch,
+                                             state0)
+
+      tf.global_variables_initializer().run()
+      expected, output, state1 = sess.run([expected, output, state1])
+      self.assertAllClose(expected[0], output)
+      for i, sub_state in enumerate(expected[1].sub):
+        self.assertAllClose(sub_state.m, state1.stacked.m[i])
+        self.assertAllClose(sub_state.c, state1.stacked.c[i])
+
+  def testStackStepComputeDtype(self):
+    with self.session(use_gpu=False) as sess:
+      stack, input_batch = self._StackStepAndInputs(residual_start=0)
+      bf16_stack, _ = self._StackStepAndInputs(
+          residual_start=0, compute_dtype=tf.bfloat16)
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      expected = stack.FPropSequence(stack.theta, prepared, input_batch)
+      actual = bf16_stack.FPropSequence(stack.theta, prepared, input_batch)
+      step_actual = self._FPropStepByStep(bf16_stack, prepared, input_batch)
+      pipelined = bf16_stack.FPropPipelined(stack.theta, prepared, input_batch)
+      self.assertEqual(tf.float32, actual[0].output.dtype)
+      self.assertEqual(tf.float32, actual[1].sub[0].c.dtype)
+      self.assertEqual(tf.float32, pipelined[0].output.dtype)
+
+      tf.global_variables_initializer().run()
+      expected, actual, step_actual, pipelined = sess.run(
+          [expected, actual, step_actual, pipelined])
+      self.assertAllClose(expected, actual, rtol=5e-2, atol=5e-2)
+      self.assertAllClose(actual, step_actual)
+      self.assertAllClose(actual, pipelined)
+
+  def testStackStepComputeDtypeUnsupported(self):
+    with self.session(use_gpu=False):
+      with self.assertRaisesRegex(ValueError, 'does not support'):
+        self._StackStepAndInputs(
+            forget_gate_bias=1.0, compute_dtype=tf.bfloat16)
+
+  def testStackStepFPropPipelined(self):
+    with self.session(use_gpu=False) as sess:
+      stack, input_batch = self._StackStepAndInputs(
+          rnn_layers=4, residual_start=1, residual_stride=2)
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      expected = self._FPropStepByStep(stack, prepared, input_batch)
+      actual = stack.FPropPipelined(stack.theta, prepared, input_batch)
+
+      tf.global_variables_initializer().run()
+      expected, actual = sess.run([expected, actual])
+      self.assertAllClose(expected, actual)
+
+  def testStackStepFPropPipelinedFused(self):
+    with self.session(use_gpu=False) as sess:
+      stack, input_batch = self._StackStepAndInputs(
+          rnn_layers=3, residual_start=1, fuse_homogeneous=True)
+      self.assertEqual([[0, 1, 2]], stack._fused_groups)  # pylint: disable=protected-access
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      expected = self._FPropStepByStep(stack, prepared, input_batch)
+      actual = stack.FPropPipelined(stack.theta, prepared, input_batch)
+
+      tf.global_variables_initializer().run()
+      expected, actual = sess.run([expected, actual])
+      self.assertAllClose(expected, actual)
+
+  def testStackStepXlaJit(self):
+    with self.session(use_gpu=False):
+      stack, input_batch = self._StackStepAndInputs(
+          residual_start=0, use_xla_jit=True)
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      graph = tf.get_default_graph()
+
+      def _NumCompiledOps():
+        return len([
+            op for op in graph.get_operations()
+            if '_XlaCompile' in op.node_def.attr
+        ])
+
+      num_compiled = _NumCompiledOps()
+      self._FPropStepByStep(stack, prepared, input_batch)
+      self.assertGreater(_NumCompiledOps(), num_compiled)
+      # The pipeline filling ticks are built outside of the loop.
+      num_compiled = _NumCompiledOps()
+      stack.FPropPipelined(stack.theta, prepared, input_batch)
+      self.assertGreater(_NumCompiledOps(), num_compiled)
+
+  def _CudnnLossAndGradients(self, layer, outputs, paddings):
+    """Returns a loss on the outputs of FPropSequence and its gradients."""
+    output, state1 = outputs
+    # cuDNN outputs zeros at padded time steps.
+    loss = tf.reduce_sum(output.output * (1.0 - paddings)) + tf.add_n(
+        [tf.reduce_sum(x) for x in state1.Flatten()])
+    return loss, tf.gradients(loss, layer.vars.Flatten())
+
+  def testStackStepCudnn(self):
+    if not tf.test.is_gpu_available(cuda_only=True):
+      self.skipTest('cuDNN is not available.')
+    with self.session(use_gpu=True) as sess:
+      stack, input_batch = self._StackStepAndInputs(cell_value_cap=None)
+      cudnn_stack, _ = self._StackStepAndInputs(
+          cell_value_cap=None, use_cudnn=True)
+      self.assertIsNotNone(cudnn_stack._cudnn)  # pylint: disable=protected-access
+      prepared = stack.PrepareExternalInputs(stack.theta, py_utils.NestedMap())
+      expected = stack.FPropSequence(stack.theta, prepared, input_batch)
+      actual = cudnn_stack.FPropSequence(stack.theta, prepared, input_batch)
+      expected_grads = self._CudnnLossAndGradients(stack, expected,
+                                                   input_batch.paddings)
+      actual_grads = self._CudnnLossAndGradients(stack, actual,
+                                                 input_batch.paddings)
+
+      tf.global_variables_initializer().run()
+      expected, actual, paddings = sess.run(
+          [expected, actual, input_batch.paddings])
+      # cuDNN outputs zeros at padded time steps.
+      self.assertAllClose(expected[0].output * (1.0 - paddings),
+                          actual[0].output)
+      self.assertAllClose(expected[1], actual[1])
+      expected_grads, actual_grads = sess.run([expected_grads, actual_grads])
+      self.assertAllClose(expected_grads, actual_grads)
+
+  def testStackStepCudnnConfig(self):
+    with self.session(use_gpu=False):
+      stack, _ = self._StackStepAndInputs(rnn_layers=2, use_cudnn=True)
+      # LSTMCellSimple caps the cell values by default.
+      self.assertIsNone(stack._cudnn)  # pylint: disable=protected-access
+
+    with self.session(use_gpu=False, graph=tf.Graph()):
+      stack, _ = self._StackStepAndInputs(
+          rnn_layers=2, use_cudnn=True, cell_value_cap=None)
+      self.assertEqual({
+          'num_layers': 2,
+          'num_units': 3,
+          'input_size': 3
+      }, stack._cudnn)  # pylint: disable=protected-access
+
+  def _BidirectionalStackStep(self, **stack_params):
+    """Returns a 2 layer BidirectionalStackStep of RnnSteps."""
+    p = step.BidirectionalStackStep.Params().Set(name='bidi', **stack_params)
+    for direction in ('fwd', 'bwd'):
+      subs = []
+      for i in range(2):
+        sub = rnn_steps.RnnStep.Params()
+        sub.name = '%s_%d' % (direction, i)
+        sub.cell.params_init = py_utils.WeightInit.Uniform(1.24, 429891685)
+        sub.cell.bias_init = py_utils.WeightInit.Uniform(1.24, 429891685)
+        sub.cell.vn.global_vn = False
+        sub.cell.vn.per_step_vn = False
+        sub.cell.num_input_nodes = 3 if i == 0 else 6
+        sub.cell.num_output_nodes = 3
+        sub.cell.cell_value_cap = None
+        subs.append(sub)
+      p.Set(**{'sub_' + direction: subs})
+    return p.Instantiate()
+
+  def testBidirectionalStackStep(self):
+    with self.session(use_gpu=False) as sess:
+      bidi = self._BidirectionalStackStep()
+      _, input_batch = self._StackStepAndInputs()
+      prepared = bidi.PrepareExternalInputs(bidi.theta, py_utils.NestedMap())
+      state0 = bidi.ZeroState(bidi.theta, prepared, 2)
+      output, state1 = bidi.FPropSequence(bidi.theta, prepared, input_batch)
+
+      def _Reverse(x):
+        return tf.reverse_sequence(x, [3, 2], seq_axis=0, batch_axis=1)
+
+      def _Run(sub, theta, prepared, inputs, paddings, state):
+        outputs = []
+        for t in range(4):
+          out, state = sub.FProp(theta, prepared,
+                                 py_utils.NestedMap(inputs=[inputs[t]]),
+                                 paddings[t], state)
+          outputs.append(out.output)
+        return tf.stack(outputs), state
+
+      inputs = input_batch.inputs[0]
+      paddings = input_batch.paddings
+      expected_state1 = py_utils.NestedMap(fwd=[], bwd=[])
+      for i in range(2):
+        fwd, fwd_state1 = _Run(bidi.sub_fwd[i], bidi.theta.sub_fwd[i],
+                               prepared.fwd[i], inputs, paddings,
+                               state0.fwd[i])
+        bwd, bwd_state1 = _Run(bidi.sub_bwd[i], bidi.theta.sub_bwd[i],
+                               prepared.bwd[i], _Reverse(inputs),
+                               _Reverse(paddings), state0.bwd[i])
+        expected_state1.fwd.append(fwd_state1)
+        expected_state1.bwd.append(bwd_state1)
+        inputs = tf.concat([fwd, _Reverse(bwd)], axis=2)
+
+      tf.global_variables_initializer().run()
+      expected, actual = sess.run([(inputs, expected_state1),
+                                   (output.output, state1)])
+      self.assertAllClose(expected, actual)
+
+      with self.assertRaises(NotImplementedError):
+        bidi.FProp(bidi.theta, prepared,
+                   py_utils.NestedMap(inputs=[input_batch.inputs[0][0]]),
+                   input_batch.paddings[0], state0)
+
+  def testBidirectionalStackStepCudnn(self):
+    if not tf.test.is_gpu_available(cuda_only=True):
+      self.skipTest('cuDNN is not available.')
+    with self.session(use_gpu=True) as sess:
+      bidi = self._BidirectionalStackStep()
+      cudnn_bidi = self._BidirectionalStackStep(use_cudnn=True)
+      self.assertIsNotNone(cudnn_bidi._cudnn)  # pylint: disable=protected-access
+      _, input_batch = self._StackStepAndInputs()
+      prepared = bidi.PrepareExternalInputs(bidi.theta, py_utils.NestedMap())
+      expected = bidi.FPropSequence(bidi.theta, prepared, input_batch)
+      actual = cudnn_bidi.FPropSequence(bidi.theta, prepared, input_batch)
+      expected_grads = self._CudnnLossAndGradients(bidi, expected,
+                                                   input_batch.paddings)
+      actual_grads = self._CudnnLossAndGradients(bidi, actual,
+                                                 input_batch.paddings)
+
+      tf.global_variables_initializer().run()
+      expected, actual, paddings = sess.run(
+          [expected, actual, input_batch.paddings])
+      # cuDNN outputs zeros at padded time steps.
+      self.assertAllClose(expected[0].output * (1.0 - paddings),
+                          actual[0].output)
+      self.assertAllClose(expected[1], actual[1])
+      expected_grads, actual_grads = sess.run([expected_grads, actual_grads])
+      self.assertAllClose(expected_grads, actual_grads)
+
+  def testBidirectionalStackStepUnsupportedParams(self):
+    with self.session(use_gpu=False):
+      with self.assertRaisesRegex(ValueError, 'skip_padded_steps'):
+        self._BidirectionalStackStep(skip_padded_steps=True)
+      with self.assertRaisesRegex(ValueError, 'compute_dtype'):
+        self._BidirectionalStackStep(compute_dtype=tf.bfloat16)
+
+  def testBidirectionalStackStepCudnnConfig(self):
+    with self.session(use_gpu=False):
+      bidi = self._BidirectionalStackStep(use_cudnn=True)
+      self.assertEqual({
+          'num_layers': 2,
+          'num_units': 3,
+          'input_size': 3
+      }, bidi._cudnn)  # pylint: disable=protected-access
+
 
 if __name__ == '__main__':
   tf.test.main()